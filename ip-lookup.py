@@ -4,171 +4,701 @@ Simple IP/DNS Lookup Script with Multiple API Fallbacks
 Reads a list of IPs or DNS names and outputs owner and region information
 """
 
+import atexit
+import base64
+import functools
+import http.client
 import socket
-import ipaddress
-import urllib.request
 import urllib.error
+import urllib.request
 import json
+import math
+import os
+import queue
+import re
 import sys
+import threading
 import time
+from collections import deque
+from collections.abc import Callable
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from urllib.parse import unquote, urljoin, urlsplit
+
+# orjson is optional, the stdlib json module parses the same response bytes otherwise
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    json_loads = json.loads
+    
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
+# Set when the run is interrupted, so waiting workers give up instead of sleeping on
+stop_event = threading.Event()
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per `per` seconds, only blocks once the bucket is empty"""
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate / self.per)
+        self.last = now
+    
+    def try_acquire(self):
+        """Take a token if one is free right now, without waiting"""
+        with self.lock:
+            self.refill()
+            if self.allowance < 1:
+                return False
+            self.allowance -= 1
+            return True
+    
+    def time_until_token(self):
+        """Seconds until a token is free, without taking it"""
+        with self.lock:
+            self.refill()
+            return max(1 - self.allowance, 0) * self.per / self.rate
+    
+    def acquire(self):
+        with self.lock:
+            self.refill()
+            # Take the token now, waiting callers queue up behind it
+            self.allowance -= 1
+            wait = -self.allowance * self.per / self.rate if self.allowance < 0 else 0
+        if wait > 0:
+            stop_event.wait(wait)
+
+@dataclass(slots=True)
 class APIProvider:
-    """Base class for API providers"""
-    def __init__(self, name, delay):
-        self.name = name
-        self.delay = delay
-        self.failed = False
+    """An API provider, its lookup URL and response parser, and its rate limiting state"""
+    name: str
+    url: str
+    parse: Callable
+    limiter: RateLimiter
+    headers: dict | None = None
+    cooldown_until: float = 0.0
+    # Moving average response time and success counts, used to order providers.
+    # The average is seeded by the first measured call
+    ewma_ms: float | None = None
+    successes: int = 1
+    total: int = 1
     
     def lookup(self, ip):
-        raise NotImplementedError
+        return do_lookup(self.url.format(ip=ip), self.headers, self.parse)
+    
+    def score(self):
+        """Expected cost of a lookup, lower is better. Providers that haven't
+        been measured yet are never ranked ahead of ones that have"""
+        if self.ewma_ms is None:
+            return math.inf
+        return self.ewma_ms * self.total / self.successes
 
-def lookup_ipapi_com(ip):
-    """Lookup using ip-api.com (45 requests/min)"""
-    try:
-        url = f"http://ip-api.com/json/{ip}?fields=status,country,regionName,org,query"
-        with urllib.request.urlopen(url, timeout=5) as response:
-            data = json.loads(response.read().decode())
-            
-            if data.get('status') == 'success':
-                owner = data.get('org', 'Unknown')
-                region = f"{data.get('regionName', 'Unknown')}, {data.get('country', 'Unknown')}"
-                return owner, region, True
-            else:
-                return "Unknown", "Unknown", True
-    except urllib.error.HTTPError as e:
-        if e.code == 429:  # Rate limit exceeded
-            return None, None, False
-        return f"HTTP Error: {e.code}", "N/A", True
-    except Exception as e:
-        return f"Error: {str(e)}", "N/A", True
+# Idle keep-alive connections kept per host, so repeated lookups skip the
+# TCP/TLS handshake
+POOL_MAXSIZE = 32
+# Separate connect and read timeouts, so a provider that is down fails fast
+CONNECT_TIMEOUT = 1.5
+READ_TIMEOUT = 3.5
+DEFAULT_HEADERS = {'User-Agent': f'Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}'}
+# Redirects followed per request, and the status codes that are followed
+MAX_REDIRECTS = 2
+REDIRECT_CODES = (301, 302, 303, 307, 308)
 
-def lookup_ipapi_co(ip):
-    """Lookup using ipapi.co (1000 requests/day, 30/min)"""
-    try:
-        url = f"https://ipapi.co/{ip}/json/"
-        req = urllib.request.Request(url)
-        req.add_header('User-Agent', 'ipapi.co/#ipapi-python/1.0.4')
+connection_pool = {}
+pool_lock = threading.Lock()
+
+@functools.cache
+def proxy_for(scheme, host):
+    """The proxy to reach host through, from the environment like urlopen, or None"""
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    # urlopen also accepts a bare host:port and treats it as an HTTP proxy
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlsplit(proxy)
+
+def proxy_headers(proxy):
+    """Proxy-Authorization header for the credentials in the proxy URL, if any"""
+    if proxy.username is None:
+        return {}
+    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()}
+
+def get_connection(scheme, host):
+    """Take an idle connection for host from the pool or open a new one"""
+    with pool_lock:
+        idle = connection_pool.get((scheme, host))
+        if idle:
+            return idle.pop()
+    proxy = proxy_for(scheme, host)
+    if scheme == 'https':
+        if proxy is None:
+            return http.client.HTTPSConnection(host, timeout=CONNECT_TIMEOUT)
+        # Tunnel TLS to host through the proxy with CONNECT
+        conn = http.client.HTTPSConnection(proxy.hostname, proxy.port, timeout=CONNECT_TIMEOUT)
+        conn.set_tunnel(host, headers=proxy_headers(proxy))
+        return conn
+    if proxy is None:
+        return http.client.HTTPConnection(host, timeout=CONNECT_TIMEOUT)
+    return http.client.HTTPConnection(proxy.hostname, proxy.port, timeout=CONNECT_TIMEOUT)
+
+def release_connection(scheme, host, conn):
+    """Return a connection to the pool, closing it if the pool is full"""
+    with pool_lock:
+        idle = connection_pool.setdefault((scheme, host), [])
+        if len(idle) < POOL_MAXSIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def close_connections():
+    """Close all idle pooled connections"""
+    with pool_lock:
+        for idle in connection_pool.values():
+            for conn in idle:
+                conn.close()
+        connection_pool.clear()
+
+atexit.register(close_connections)
+
+def send_request(url, data, headers):
+    """Send one request over a pooled connection, returning the response and its body"""
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    request_headers = {**DEFAULT_HEADERS, **(headers or {})}
+    # Plain HTTP proxies take the full URL, HTTPS goes through a tunnel instead
+    proxy = proxy_for(parts.scheme, parts.netloc)
+    if proxy and parts.scheme == 'http':
+        path = f"http://{parts.netloc}{path}"
+        request_headers.update(proxy_headers(proxy))
+    
+    for attempt in range(2):
+        conn = get_connection(parts.scheme, parts.netloc)
+        reused = conn.sock is not None
+        try:
+            if not reused:
+                conn.connect()
+                conn.sock.settimeout(READ_TIMEOUT)
+            conn.request('GET' if data is None else 'POST', path, body=data, headers=request_headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            conn.close()
+            # The server dropped an idle keep-alive connection, retry on a fresh one
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
         
-        with urllib.request.urlopen(req, timeout=5) as response:
-            data = json.loads(response.read().decode())
-            
-            if 'error' in data:
-                if data.get('reason') == 'RateLimited':
-                    return None, None, False
-                return "Unknown", "Unknown", True
-            
-            owner = data.get('org', 'Unknown')
-            region = f"{data.get('region', 'Unknown')}, {data.get('country_name', 'Unknown')}"
-            return owner, region, True
-    except urllib.error.HTTPError as e:
-        if e.code == 429:  # Rate limit exceeded
-            return None, None, False
-        return f"HTTP Error: {e.code}", "N/A", True
-    except Exception as e:
-        return f"Error: {str(e)}", "N/A", True
+        if response.will_close:
+            conn.close()
+        else:
+            release_connection(parts.scheme, parts.netloc, conn)
+        return response, body
+
+def http_request(url, data=None, headers=None):
+    """GET url (or POST data to it) over a pooled connection, returning the body
+    and response headers. Like urlopen, follows redirects, uses the proxies
+    from the environment and raises urllib.error.HTTPError on error status codes."""
+    for _ in range(MAX_REDIRECTS + 1):
+        response, body = send_request(url, data, headers)
+        location = response.headers.get('Location')
+        if response.status not in REDIRECT_CODES or not location:
+            break
+        url = urljoin(url, location)
+        # A POST is resent as a GET, except on 307 and 308
+        if response.status not in (307, 308):
+            data = None
+    
+    if response.status >= 300:
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+    return body, response.headers
+
+# Seconds to pause a rate limited provider when it doesn't say how long
+DEFAULT_COOLDOWN = 60
+
+# Outcome of a provider lookup: it answered with data, answered that it has
+# no data for the IP (e.g. a private or reserved address), the request failed
+# or the provider can't answer right now (e.g. a used up quota), or the
+# provider is rate limited
+OK = 'ok'
+NO_DATA = 'no data'
+FAILED = 'failed'
+RATE_LIMITED = 'rate limited'
+
+# Messages of replies without data that are about the IP itself, any other
+# such reply counts as a failed request so the next provider is tried
+NO_DATA_PATTERN = re.compile(r'reserved|private|invalid', re.IGNORECASE)
 
-def lookup_ipwhois_io(ip):
-    """Lookup using ipwhois.io (10000 requests/month, free tier)"""
+def reply_without_data(message):
+    """Result for a provider reply that carries no data, given its message"""
+    if NO_DATA_PATTERN.search(message or ''):
+        return "Unknown", "Unknown", NO_DATA, 0
+    return f"Error: {message or 'no data returned'}", "N/A", FAILED, 0
+
+def cooldown_from_headers(headers):
+    """Seconds until a provider accepts requests again, from its Retry-After or
+    ip-api.com's X-Ttl header"""
+    value = headers.get('Retry-After') or headers.get('X-Ttl')
     try:
-        url = f"http://ipwho.is/{ip}"
-        with urllib.request.urlopen(url, timeout=5) as response:
-            data = json.loads(response.read().decode())
-            
-            if not data.get('success', False):
-                return "Unknown", "Unknown", True
-            
-            connection = data.get('connection', {})
-            owner = connection.get('org', 'Unknown')
-            if owner == 'Unknown' or owner == '':
-                owner = connection.get('isp', 'Unknown')
-            
-            region = f"{data.get('region', 'Unknown')}, {data.get('country', 'Unknown')}"
-            return owner, region, True
-    except urllib.error.HTTPError as e:
-        if e.code == 429:  # Rate limit exceeded
-            return None, None, False
-        return f"HTTP Error: {e.code}", "N/A", True
-    except Exception as e:
-        return f"Error: {str(e)}", "N/A", True
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return DEFAULT_COOLDOWN
 
-def lookup_ipwhois_app(ip):
-    """Lookup using ipwhois.app (10000 requests/month)"""
+def do_lookup(url, headers, parse):
+    """Fetch a provider's JSON response and parse it into (owner, region, status, cooldown)"""
     try:
-        url = f"http://ipwhois.app/json/{ip}"
-        with urllib.request.urlopen(url, timeout=5) as response:
-            data = json.loads(response.read().decode())
-            
-            if not data.get('success', False):
-                return "Unknown", "Unknown", True
-            
-            owner = data.get('org', 'Unknown')
-            if owner == 'Unknown' or owner == '':
-                owner = data.get('isp', 'Unknown')
-            
-            region = f"{data.get('region', 'Unknown')}, {data.get('country', 'Unknown')}"
-            return owner, region, True
+        body, response_headers = http_request(url, headers=headers)
+        return parse(json_loads(body), response_headers)
     except urllib.error.HTTPError as e:
         if e.code == 429:  # Rate limit exceeded
-            return None, None, False
-        return f"HTTP Error: {e.code}", "N/A", True
+            return None, None, RATE_LIMITED, cooldown_from_headers(e.headers)
+        return f"HTTP Error: {e.code}", "N/A", FAILED, 0
     except Exception as e:
-        return f"Error: {str(e)}", "N/A", True
+        return f"Error: {str(e)}", "N/A", FAILED, 0
+
+def parse_ipapi_com(data, headers):
+    """Parse an ip-api.com response (45 requests/min)"""
+    # X-Rl is the number of requests left in the current window, back off
+    # before the next request would be rejected
+    cooldown = cooldown_from_headers(headers) if headers.get('X-Rl') == '0' else 0
+    if data.get('status') == 'success':
+        owner = data.get('org', 'Unknown')
+        region = f"{data.get('regionName', 'Unknown')}, {data.get('country', 'Unknown')}"
+        return owner, region, OK, cooldown
+    else:
+        # ip-api.com only fails for private, reserved and invalid addresses
+        return "Unknown", "Unknown", NO_DATA, cooldown
+
+def parse_ipapi_co(data, headers):
+    """Parse an ipapi.co response (1000 requests/day, 30/min)"""
+    if 'error' in data:
+        if data.get('reason') == 'RateLimited':
+            return None, None, RATE_LIMITED, cooldown_from_headers(headers)
+        return reply_without_data(data.get('reason'))
+    
+    owner = data.get('org', 'Unknown')
+    region = f"{data.get('region', 'Unknown')}, {data.get('country_name', 'Unknown')}"
+    return owner, region, OK, 0
+
+def parse_ipwhois_io(data, headers):
+    """Parse an ipwhois.io response (10000 requests/month, free tier)"""
+    if not data.get('success', False):
+        return reply_without_data(data.get('message'))
+    
+    connection = data.get('connection', {})
+    owner = connection.get('org', 'Unknown')
+    if owner == 'Unknown' or owner == '':
+        owner = connection.get('isp', 'Unknown')
+    
+    region = f"{data.get('region', 'Unknown')}, {data.get('country', 'Unknown')}"
+    return owner, region, OK, 0
 
-# API providers in order of preference
+def parse_ipwhois_app(data, headers):
+    """Parse an ipwhois.app response (10000 requests/month)"""
+    if not data.get('success', False):
+        return reply_without_data(data.get('message'))
+    
+    owner = data.get('org', 'Unknown')
+    if owner == 'Unknown' or owner == '':
+        owner = data.get('isp', 'Unknown')
+    
+    region = f"{data.get('region', 'Unknown')}, {data.get('country', 'Unknown')}"
+    return owner, region, OK, 0
+
+def lookup_ipapi_com_batch(ips):
+    """Lookup up to 100 IPs in one request using ip-api.com's batch endpoint (15 requests/min)
+    Returns (owner, region, status) in the same order as ips, or None if the batch request failed"""
+    try:
+        url = "http://ip-api.com/batch?fields=status,country,regionName,org,query"
+        body, _ = http_request(url, json_dumps(ips), {'Content-Type': 'application/json'})
+        data = json_loads(body)
+    except Exception:
+        return None
+    # Errors come back as an object instead of a list of results
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        return None
+    
+    results = []
+    for item in data:
+        if item.get('status') == 'success':
+            owner = item.get('org', 'Unknown')
+            region = f"{item.get('regionName', 'Unknown')}, {item.get('country', 'Unknown')}"
+            results.append((owner, region, OK))
+        else:
+            results.append(("Unknown", "Unknown", NO_DATA))
+    return results
+
+# API providers in order of preference, reordered at runtime by observed
+# latency and success rate
 API_PROVIDERS = [
-    {'name': 'ip-api.com', 'func': lookup_ipapi_com, 'delay': 1.5, 'failed': False},
-    {'name': 'ipapi.co', 'func': lookup_ipapi_co, 'delay': 2.0, 'failed': False},
-    {'name': 'ipwho.is', 'func': lookup_ipwhois_io, 'delay': 1.0, 'failed': False},
-    {'name': 'ipwhois.app', 'func': lookup_ipwhois_app, 'delay': 1.0, 'failed': False},
+    APIProvider('ip-api.com', "http://ip-api.com/json/{ip}?fields=status,country,regionName,org,query",
+                parse_ipapi_com, RateLimiter(45, 60)),
+    APIProvider('ipapi.co', "https://ipapi.co/{ip}/json/",
+                parse_ipapi_co, RateLimiter(30, 60),
+                headers={'User-Agent': 'ipapi.co/#ipapi-python/1.0.4'}),
+    APIProvider('ipwho.is', "http://ipwho.is/{ip}",
+                parse_ipwhois_io, RateLimiter(60, 60)),
+    APIProvider('ipwhois.app', "http://ipwhois.app/json/{ip}",
+                parse_ipwhois_app, RateLimiter(60, 60)),
 ]
+# Original position of each provider, breaks ties between equal scores
+PREFERENCE = {provider.name: i for i, provider in enumerate(API_PROVIDERS)}
 
-current_provider_index = 0
+# Maximum number of entries looked up concurrently, and queued or waiting to
+# be written, beyond the oldest unfinished one
+MAX_WORKERS = 32
+MAX_PENDING = MAX_WORKERS * 4
 
-def lookup_ip_with_fallback(ip):
-    """Lookup IP with automatic fallback to alternative APIs"""
-    global current_provider_index
+@contextmanager
+def worker_pool(max_workers):
+    """Thread pool that drops its queued work instead of finishing it when
+    the block is left with an exception, e.g. on Ctrl-C"""
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        yield executor
+    except BaseException:
+        stop_event.set()
+        executor.shutdown(cancel_futures=True)
+        raise
+    executor.shutdown()
+
+# A provider that hasn't answered after this many seconds is raced against the next one
+HEDGE_DELAY = 1.0
+
+# Weight of the newest response time in each provider's moving average, and
+# how many provider calls to make between reordering API_PROVIDERS
+EWMA_WEIGHT = 0.2
+REORDER_INTERVAL = 32
+
+provider_lock = threading.Lock()
+calls_since_reorder = 0
+provider_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS * len(API_PROVIDERS))
+
+def call_provider(provider, ip):
+    """Run one provider lookup and record how it went"""
+    start = time.monotonic()
+    result = provider.lookup(ip)
+    record_call(provider, (time.monotonic() - start) * 1000, result[2] in (OK, NO_DATA))
+    return result
+
+def record_call(provider, elapsed_ms, ok):
+    """Update a provider's statistics, and periodically put the providers
+    with the lowest expected cost first"""
+    global calls_since_reorder
     
-    attempts = 0
-    while attempts < len(API_PROVIDERS):
-        provider = API_PROVIDERS[current_provider_index]
+    with provider_lock:
+        # Only answered calls are timed, a provider that is down and refuses
+        # connections would otherwise look like the fastest one
+        if ok and provider.ewma_ms is None:
+            provider.ewma_ms = elapsed_ms
+        elif ok:
+            provider.ewma_ms = EWMA_WEIGHT * elapsed_ms + (1 - EWMA_WEIGHT) * provider.ewma_ms
+        provider.total += 1
+        provider.successes += int(ok)
         
-        # Skip if provider has failed
-        if provider['failed']:
-            current_provider_index = (current_provider_index + 1) % len(API_PROVIDERS)
-            attempts += 1
+        calls_since_reorder += 1
+        if calls_since_reorder >= REORDER_INTERVAL:
+            calls_since_reorder = 0
+            # Swap the contents in one step, lookups copy the list without the lock
+            API_PROVIDERS[:] = sorted(
+                API_PROVIDERS, key=lambda p: (p.score(), PREFERENCE[p.name]))
+
+def is_cooling_down(provider):
+    """Check if a provider is paused after hitting its rate limit"""
+    return time.monotonic() < provider.cooldown_until
+
+def pause_provider(provider, cooldown):
+    """Skip a provider until its rate limit window has passed"""
+    with provider_lock:
+        newly_paused = not is_cooling_down(provider)
+        if newly_paused:
+            print(f"  ⚠️  Rate limit hit on {provider.name}, pausing it for {cooldown}s...")
+        provider.cooldown_until = max(provider.cooldown_until, time.monotonic() + cooldown)
+        # Tell once, when the last provider that was still available is paused
+        if newly_paused and all(is_cooling_down(p) for p in API_PROVIDERS):
+            print("  ⏳ All providers are rate limited, waiting for the first one to come back...")
+
+def lookup_ip_with_fallback(ip):
+    """Lookup IP with automatic fallback to alternative APIs, waiting for a
+    provider to come back when all of them are rate limited"""
+    while not stop_event.is_set():
+        result = try_providers(ip)
+        if result:
+            return result
+        # Every provider is paused, wait for the first one to come back
+        with provider_lock:
+            resume_at = min(p.cooldown_until for p in API_PROVIDERS)
+        stop_event.wait(max(resume_at - time.monotonic(), 0))
+    
+    return "Lookup interrupted", "N/A", "None", FAILED
+
+def try_providers(ip):
+    """Try the providers that aren't paused in order, a slow provider is raced
+    against the next one and the first successful answer wins. A failed request
+    moves on to the next provider, its error is returned if no provider answers.
+    Returns (owner, region, api_used, status), or None if every provider was
+    rate limited"""
+    candidates = list(API_PROVIDERS)
+    running = {}
+    error = None
+    
+    def start_next(block):
+        # Start the first provider that isn't cooling down and has a token free
+        # right away. If none has one, start nothing unless block is set, so a
+        # hedge never waits for a token. Otherwise wait for the next free token
+        # or the next end of a cooldown among the candidates, whichever comes
+        # first, and check them all again, so no worker queues up behind one
+        # provider while the others are free. The hedge timer runs from when
+        # the request is sent.
+        while not stop_event.is_set():
+            available = [p for p in candidates if not is_cooling_down(p)]
+            provider = next((p for p in available if p.limiter.try_acquire()), None)
+            if provider is not None:
+                candidates.remove(provider)
+                running[provider_executor.submit(call_provider, provider, ip)] = provider
+                return
+            if not block or not available:
+                return
+            now = time.monotonic()
+            waits = [p.limiter.time_until_token() for p in available]
+            waits += [p.cooldown_until - now for p in candidates if p not in available]
+            stop_event.wait(max(min(waits), 0))
+    
+    start_next(block=True)
+    while running and not stop_event.is_set():
+        done, _ = wait(running, timeout=HEDGE_DELAY, return_when=FIRST_COMPLETED)
+        if not done:
+            start_next(block=False)
             continue
         
-        # Try the current provider
-        owner, region, success = provider['func'](ip)
+        outcomes = [(running.pop(future), future.result()) for future in done]
+        for provider, (_, _, _, cooldown) in outcomes:
+            if cooldown:
+                pause_provider(provider, cooldown)
+        # Look for an answer among all finished calls before starting another
+        # provider, so no token is spent on a call whose result is dropped
+        for provider, (owner, region, status, _) in outcomes:
+            if status in (OK, NO_DATA):
+                # The provider answered
+                return owner, region, provider.name, status
         
-        if success:
-            # Successful lookup
-            return owner, region, provider['name'], provider['delay']
+        for provider, (owner, region, status, _) in outcomes:
+            if status == FAILED:
+                # Request failed, keep the error in case no other provider
+                # answers, and let the ones already running finish first
+                error = owner, region, provider.name, status
+                if running:
+                    continue
+            # Rate limit hit or request failed, switch to next provider
+            start_next(block=not running)
+    
+    return error
+
+# Lookup results are cached per IP and appended to a JSON lines file as they
+# come in, so later runs can reuse them
+CACHE_FILE = os.path.expanduser('~/.cache/ip-lookup.jsonl')
+CACHE_TTL = 24 * 60 * 60
+
+lookup_cache = {}
+cache_lock = threading.Lock()
+# Lookups in progress per IP, so duplicates wait for the first one
+in_flight = {}
+cache_out = None
+
+def fresh_cached(ip):
+    """Return the unexpired cached (owner, region, api_used) for IP, or None.
+    The caller holds cache_lock"""
+    cached = lookup_cache.get(ip)
+    if cached and time.time() - cached[3] < CACHE_TTL:
+        return cached[:3]
+    return None
+
+def get_cached(ip):
+    """Return the cached (owner, region, api_used) for IP, or None"""
+    with cache_lock:
+        return fresh_cached(ip)
+
+def cache_line(ip, owner, region, api_used, timestamp):
+    """Format a cache entry as a line of the cache file"""
+    return json_dumps({'ip': ip, 'owner': owner, 'region': region, 'api': api_used, 'ts': timestamp}) + b'\n'
+
+def cache_result(ip, owner, region, api_used, status):
+    """Store a lookup result in the cache and the cache file"""
+    global cache_out
+    
+    # Don't cache errors or interrupted lookups, those are worth retrying.
+    # A provider having no data for the IP is an answer and is cached
+    if status not in (OK, NO_DATA):
+        return
+    
+    timestamp = time.time()
+    with cache_lock:
+        lookup_cache[ip] = (owner, region, api_used, timestamp)
+        if cache_out:
+            try:
+                cache_out.write(cache_line(ip, owner, region, api_used, timestamp))
+                cache_out.flush()
+            except OSError as e:
+                print(f"Warning: could not write lookup cache: {e}")
+                cache_out = None
+
+def cached_lookup(ip):
+    """Lookup IP through the result cache, sharing the result of a lookup
+    another worker already started for the same IP"""
+    with cache_lock:
+        cached = fresh_cached(ip)
+        if cached:
+            return cached
+        pending = in_flight.get(ip)
+        if pending is None:
+            pending = in_flight[ip] = Future()
+            started = True
         else:
-            # Rate limit hit, switch to next provider
-            print(f"  ⚠️  Rate limit hit on {provider['name']}, switching to next provider...")
-            provider['failed'] = True
-            current_provider_index = (current_provider_index + 1) % len(API_PROVIDERS)
-            attempts += 1
+            started = False
+    if not started:
+        return pending.result()
     
-    # All providers failed
-    return "All APIs exhausted", "N/A", "None", 0
+    try:
+        owner, region, api_used, status = lookup_ip_with_fallback(ip)
+        cache_result(ip, owner, region, api_used, status)
+        pending.set_result((owner, region, api_used))
+        return owner, region, api_used
+    except BaseException as e:
+        pending.set_exception(e)
+        raise
+    finally:
+        with cache_lock:
+            del in_flight[ip]
+
+# IPs per ip-api.com batch request, the batch endpoint has its own rate limit
+BATCH_SIZE = 100
+BATCH_LIMITER = RateLimiter(15, 60)
+
+def lookup_batches(ips):
+    """Lookup IPs in batches and cache the results, IPs a failed batch
+    didn't cover are left to the single IP providers"""
+    for start in range(0, len(ips), BATCH_SIZE):
+        batch = ips[start:start + BATCH_SIZE]
+        BATCH_LIMITER.acquire()
+        results = lookup_ipapi_com_batch(batch)
+        if results is None:
+            print("  ⚠️  Batch lookup failed on ip-api.com, falling back to single lookups...\n")
+            return
+        
+        for ip, (owner, region, status) in zip(batch, results):
+            cache_result(ip, owner, region, 'ip-api.com', status)
+
+def load_cache():
+    """Load unexpired lookup results saved by previous runs and open the
+    cache file to append new ones"""
+    global cache_out
+    
+    lines = 0
+    complete = True
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            now = time.time()
+            for line in f:
+                lines += 1
+                complete = line.endswith(b'\n')
+                try:
+                    item = json_loads(line)
+                    if now - item['ts'] < CACHE_TTL:
+                        lookup_cache[item['ip']] = (item['owner'], item['region'], item['api'], item['ts'])
+                except (ValueError, KeyError, TypeError):
+                    # Skip lines cut short by an interrupted run
+                    continue
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Warning: could not read lookup cache: {e}")
+    
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        # Rewrite the file once expired and superseded lines make up most of
+        # it, or when an interrupted write left the last line unfinished
+        if lines > 2 * len(lookup_cache) or not complete:
+            tmp_file = CACHE_FILE + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                for ip, entry in lookup_cache.items():
+                    f.write(cache_line(ip, *entry))
+            os.replace(tmp_file, CACHE_FILE)
+        cache_out = open(CACHE_FILE, 'ab')
+    except OSError as e:
+        print(f"Warning: could not open lookup cache: {e}")
+
+def close_cache():
+    """Close the cache file"""
+    global cache_out
+    
+    with cache_lock:
+        if cache_out:
+            cache_out.close()
+            cache_out = None
 
 def resolve_dns(hostname):
     """Resolve DNS name to IP address"""
+    # getaddrinfo also returns IPv6 addresses, unlike gethostbyname
     try:
-        return socket.gethostbyname(hostname)
-    except socket.gaierror:
+        return socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)[0][4][0]
+    except (socket.gaierror, UnicodeError):
+        # UnicodeError is raised by the idna encoding for names like "a..b"
         return None
 
+# Dotted quad with octets 0-255 and no leading zeros
+IPV4_PATTERN = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])')
+
 def is_valid_ip(ip):
     """Check if string is a valid IP address"""
+    if IPV4_PATTERN.fullmatch(ip):
+        return True
+    if ':' not in ip:
+        return False
+    # AI_NUMERICHOST only parses the string and never queries DNS
     try:
-        ipaddress.ip_address(ip)
+        socket.getaddrinfo(ip, None, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST)
         return True
-    except ValueError:
+    except (socket.gaierror, ValueError):
         return False
 
+def format_result(result):
+    """Format a lookup result for the output file"""
+    return (f"Input: {result['input']}\n"
+            f"IP Address: {result['ip']}\n"
+            f"Owner: {result['owner']}\n"
+            f"Region: {result['region']}\n"
+            f"API Used: {result['api_used']}\n"
+            + "-" * 80 + "\n\n")
+
+def write_results(f, results):
+    """Write (index, result) items from the results queue in input order, until None"""
+    ready = {}
+    next_index = 1
+    while True:
+        item = results.get()
+        if item is None:
+            break
+        
+        index, result = item
+        ready[index] = result
+        while next_index in ready:
+            f.write(format_result(ready.pop(next_index)))
+            next_index += 1
+
 def process_file(input_file, output_file):
     """Process input file and write results to output file"""
     try:
@@ -181,62 +711,82 @@ def process_file(input_file, output_file):
         print(f"Error reading file: {e}")
         return
 
-    results = []
     print(f"Processing {len(entries)} entries...\n")
     
-    for i, entry in enumerate(entries, 1):
-        print(f"[{i}/{len(entries)}] Checking: {entry}")
-        
-        # Determine if it's an IP or DNS name
-        if is_valid_ip(entry):
-            ip = entry
-        else:
-            # Try to resolve as DNS name
-            ip = resolve_dns(entry)
-            if not ip:
-                print(f"  ❌ Could not resolve DNS name\n")
-                results.append({
-                    'input': entry,
-                    'ip': 'N/A',
-                    'owner': 'DNS resolution failed',
-                    'region': 'N/A',
-                    'api_used': 'N/A'
-                })
-                continue
+    # Resolve each distinct DNS name once, up front and concurrently, so the IPs
+    # can be looked up in batches
+    unique = list(dict.fromkeys(entries))
+    resolved = {entry: entry for entry in unique if is_valid_ip(entry)}
+    hosts = [entry for entry in unique if entry not in resolved]
+    if hosts:
+        with worker_pool(MAX_WORKERS) as executor:
+            resolved.update(zip(hosts, executor.map(resolve_dns, hosts)))
+    
+    pending = [ip for ip in dict.fromkeys(resolved.values()) if ip and not get_cached(ip)]
+    lookup_batches(pending)
+    
+    def handle(i, entry):
+        ip = resolved[entry]
+        if not ip:
+            print(f"[{i}/{len(entries)}] Checking: {entry}\n"
+                  f"  ❌ Could not resolve DNS name\n")
+            return {
+                'input': entry,
+                'ip': 'N/A',
+                'owner': 'DNS resolution failed',
+                'region': 'N/A',
+                'api_used': 'N/A'
+            }
         
         # Lookup IP information with automatic fallback
-        owner, region, api_used, delay = lookup_ip_with_fallback(ip)
-        print(f"  IP: {ip}")
-        print(f"  Owner: {owner}")
-        print(f"  Region: {region}")
-        print(f"  API Used: {api_used}\n")
+        owner, region, api_used = cached_lookup(ip)
+        print(f"[{i}/{len(entries)}] Checking: {entry}\n"
+              f"  IP: {ip}\n"
+              f"  Owner: {owner}\n"
+              f"  Region: {region}\n"
+              f"  API Used: {api_used}\n")
         
-        results.append({
+        return {
             'input': entry,
             'ip': ip,
             'owner': owner,
             'region': region,
             'api_used': api_used
-        })
-        
-        # Rate limiting delay
-        if delay > 0 and i < len(entries):
-            time.sleep(delay)
+        }
+    
+    def produce(i, entry):
+        results.put((i, handle(i, entry)))
     
-    # Write results to output file
+    # Look up all entries concurrently, a single writer thread writes each
+    # result as soon as it is ready so workers never wait on the file
+    results = queue.Queue()
     try:
-        with open(output_file, 'w') as f:
+        with open(output_file, 'w', buffering=1) as f:
             f.write("=" * 80 + "\n")
             f.write("IP/DNS LOOKUP RESULTS\n")
             f.write("=" * 80 + "\n\n")
             
-            for result in results:
-                f.write(f"Input: {result['input']}\n")
-                f.write(f"IP Address: {result['ip']}\n")
-                f.write(f"Owner: {result['owner']}\n")
-                f.write(f"Region: {result['region']}\n")
-                f.write(f"API Used: {result['api_used']}\n")
-                f.write("-" * 80 + "\n\n")
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                written = writer.submit(write_results, f, results)
+                try:
+                    with worker_pool(MAX_WORKERS) as executor:
+                        # Only submit new entries as the oldest ones finish, which
+                        # also bounds how many results the writer holds back
+                        window = deque()
+                        for i, entry in enumerate(entries, 1):
+                            # The writer only stops early when it failed, stop
+                            # looking up entries nobody will write and raise its error
+                            if written.done():
+                                written.result()
+                            if len(window) >= MAX_PENDING:
+                                window.popleft().result()
+                            window.append(executor.submit(produce, i, entry))
+                        for future in window:
+                            future.result()
+                finally:
+                    results.put(None)
+                # Re-raise any error from the writer
+                written.result()
         
         print(f"\n✅ Results saved to '{output_file}'")
     except Exception as e:
@@ -251,7 +801,7 @@ def main():
         print("  google.com")
         print("  1.1.1.1")
         print("\nSupported APIs (with automatic fallback):")
-        print("  1. ip-api.com (45 req/min)")
+        print("  1. ip-api.com (45 req/min, batches of 100 IPs at 15 req/min)")
         print("  2. ipapi.co (1000 req/day, 30 req/min)")
         print("  3. ipwho.is (10000 req/month)")
         print("  4. ipwhois.app (10000 req/month)")
@@ -260,7 +810,12 @@ def main():
     input_file = sys.argv[1]
     output_file = sys.argv[2]
     
-    process_file(input_file, output_file)
+    load_cache()
+    try:
+        process_file(input_file, output_file)
+    finally:
+        close_cache()
+        provider_executor.shutdown(cancel_futures=True)
 
 if __name__ == "__main__":
     main()